@@ -2,51 +2,150 @@
 """Host Statistic Information to MQTT."""
 
 import argparse
-import json
+import asyncio
+import functools
 import logging
 import platform
 import os
-import sched
+import signal
 import time
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from decimal import Decimal, getcontext
 
+import orjson
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import psutil
 import yaml
 from slugify import slugify
-from yaml import Dumper
+
+try:  # prefer the libyaml bindings when PyYAML was built with them
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
 
 from . import __version__
-getcontext().prec = 2
 
-MQTT_BASE_TOPIC = f"ps2mqtt/{slugify(platform.node())}"
+NODE = platform.node()
+NODE_SLUG = slugify(NODE)
+
+MQTT_BASE_TOPIC = f"ps2mqtt/{NODE_SLUG}"
 MQTT_PS2MQTT_STATUS = "{}/status"
 MQTT_STATE_TOPIC = "{}/{}"
 MQTT_AVAILABLE = "online"
 MQTT_NOT_AVAILABLE = "offline"
 HA_DISCOVERY_PREFIX = "{}/sensor/ps2mqtt_{}/{}/config"
 
+# unchanged values are still republished every N ticks for late subscribers
+REPUBLISH_UNCHANGED_TICKS = 10
+# storage usage barely moves between ticks, don't statfs more often than this
+DISK_USAGE_TTL = 30
+# consecutive failed reads before a property is dropped
+MAX_FAILURES = 3
+# psutil needs at least 0.1s between readings for cpu_percent to mean anything
+MIN_FIRST_TICK_DELAY = 1
+# keep our session on the broker across reconnects, see session_present
+SESSION_EXPIRY = 3600
+
 OPTIONAL_ATTR = ["device_class", "icon", "unit_of_measurement"]
 
+HA_DEVICE = {
+    "identifiers": f"{NODE}_ps2mqtt",
+    "name": NODE,
+    "sw_version": platform.platform(),
+    "model": platform.system(),
+    "manufacturer": f"ps2mqtt {__version__}",
+}
+
 log_format = "%(asctime)s %(levelname)s: %(message)s"
 logging.basicConfig(format=log_format, level=os.environ.get("LOGLEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
 last = {}
+published = {}
+published_lock = threading.Lock()  # cleared from the paho thread
+ha_discovery_sent = False
+failures = {}
+disabled = set()
+failed_sources = set()
+# the /proc, sysfs and statfs reads block in syscalls, keep them off the event loop
+executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="ps2mqtt")
 
 
-def rate(key, value):
+def rate(key, value, now):
     """Calculate running rates."""
-    rate = 0
-    now = time.time()
+    rate = 0.0
     if key in last:
         ltime, lvalue = last[key]
-        rate = Decimal(value - lvalue) / Decimal(now - ltime)
+        rate = (value - lvalue) / (now - ltime)
     last[key] = now, value
 
-    return float(rate)
+    return rate
+
+
+def ttl_cache(ttl):
+    """Cache results per arguments for ttl seconds."""
+
+    def decorator(func):
+        cache = {}
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            now = time.monotonic()
+            if args in cache and now - cache[args][0] < ttl:
+                return cache[args][1]
+            value = func(*args)
+            cache[args] = now, value
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+@ttl_cache(DISK_USAGE_TTL)
+def disk_usage(path):
+    """Storage usage of path in percent."""
+    return psutil.disk_usage(path).percent
+
+
+def format_value(call, snap):
+    """Call a property and format its value for publishing."""
+    value = call(snap)
+    if isinstance(value, (int, str)):
+        return value
+    return f"{value:.1f}"  # drop the float tail from the payload
+
+
+def read_source(name, source):
+    """Read a psutil source, None if it failed so only its properties fail."""
+    try:
+        value = source()
+    except Exception as e:
+        if name not in failed_sources:  # log once until it recovers
+            logger.error("Reading %s: %s", name, e)
+            failed_sources.add(name)
+        return None
+    if name in failed_sources:
+        logger.info("Reading %s recovered", name)
+        failed_sources.discard(name)
+    return value
+
+
+def snapshot():
+    """Read each psutil source once for the current tick."""
+    return {
+        "cpu": read_source("cpu", lambda: psutil.cpu_percent(interval=None)),
+        "vm": read_source("vm", psutil.virtual_memory),
+        "net": read_source("net", psutil.net_io_counters),
+        "net_time": time.monotonic(),
+        "temps": read_source("temps", psutil.sensors_temperatures)
+        if hasattr(psutil, "sensors_temperatures")
+        else {},
+    }
 
 
 def load_properties(storage_path_list):
@@ -55,39 +154,41 @@ def load_properties(storage_path_list):
         "cpu_percent": {
             "unit_of_measurement": "%",
             "icon": "mdi:chip",
-            "call": lambda: psutil.cpu_percent(interval=None),
+            "call": lambda snap: snap["cpu"],
         },
         "virtual_memory": {
             "unit_of_measurement": "%",
             "icon": "mdi:memory",
-            "call": lambda: psutil.virtual_memory().percent,
+            "call": lambda snap: snap["vm"].percent,
         },
         "uptime": {
             "device_class": "timestamp",
-            "call": lambda: datetime.fromtimestamp(psutil.boot_time())
+            "call": lambda snap: datetime.fromtimestamp(psutil.boot_time())
             .astimezone()
             .isoformat(),
         },
         "bytes_sent": {
             "unit_of_measurement": "MiB",
             "icon": "mdi:upload-network",
-            "call": lambda: int(psutil.net_io_counters().bytes_sent / 1000000),
+            "call": lambda snap: snap["net"].bytes_sent >> 20,
         },
         "bytes_recv": {
             "unit_of_measurement": "MiB",
             "icon": "mdi:download-network",
-            "call": lambda: int(psutil.net_io_counters().bytes_recv / 1000000),
+            "call": lambda snap: snap["net"].bytes_recv >> 20,
         },
         "upload": {
             "unit_of_measurement": "kbps",
             "icon": "mdi:upload-network",
-            "call": lambda: rate("upload", psutil.net_io_counters().bytes_sent / 1000),
+            "call": lambda snap: rate(
+                "upload", snap["net"].bytes_sent / 1000, snap["net_time"]
+            ),
         },
         "download": {
             "unit_of_measurement": "kbps",
             "icon": "mdi:download-network",
-            "call": lambda: rate(
-                "download", psutil.net_io_counters().bytes_recv / 1000
+            "call": lambda snap: rate(
+                "download", snap["net"].bytes_recv / 1000, snap["net_time"]
             ),
         },
     }
@@ -97,7 +198,7 @@ def load_properties(storage_path_list):
         properties[f"{disk_name}_disk_usage"] = {
             "unit_of_measurement": "%",
             "icon": "mdi:harddisk",
-            "call": lambda: psutil.disk_usage(path).percent,
+            "call": lambda snap, path=path: disk_usage(path),
         }
 
     if hasattr(psutil, "sensors_temperatures"):
@@ -105,7 +206,8 @@ def load_properties(storage_path_list):
             properties[temp_sensor] = {
                 "unit_of_measurement": "°C",
                 "device_class": "temperature",
-                "call": lambda: psutil.sensors_temperatures()[temp_sensor][0].current,
+                # bind the loop variables, otherwise every lambda reads the last one
+                "call": lambda snap, t=temp_sensor: snap["temps"][t][0].current,
             }
 
     return properties
@@ -113,78 +215,143 @@ def load_properties(storage_path_list):
 
 def gen_ha_config(sensor, properties, base_topic):
     """Generate Home Assistant Configuration."""
+    sensor_id = slugify(f"{NODE} {sensor}")
     json_config = {
         "name": sensor,
-        "unique_id": slugify(f"{platform.node()} {sensor}"),
-        "object_id": slugify(f"{platform.node()} {sensor}"),
-        "state_topic": MQTT_STATE_TOPIC.format(base_topic, sensor),
+        "unique_id": sensor_id,
+        "object_id": sensor_id,
+        "state_topic": properties[sensor]["state_topic"],
         "availability_topic": MQTT_PS2MQTT_STATUS.format(base_topic),
         "payload_available": MQTT_AVAILABLE,
         "payload_not_available": MQTT_NOT_AVAILABLE,
-        "device": {
-            "identifiers": f"{platform.node()}_ps2mqtt",
-            "name": f"{platform.node()}",
-            "sw_version": platform.platform(),
-            "model": platform.system(),
-            "manufacturer": f"ps2mqtt {__version__}",
-        },
+        "device": HA_DEVICE,
     }
     for attr in OPTIONAL_ATTR:
         if attr in properties[sensor]:
             json_config[attr] = properties[sensor][attr]
 
-    return json.dumps(json_config)
+    return orjson.dumps(json_config)
 
 
-def status(mqttc, properties, status_scheduler, period, base_topic):
-    """Publish status and schedule the next."""
-    for p in properties.keys():
-        try:
-            mqttc.publish(
-                MQTT_STATE_TOPIC.format(base_topic, p), properties[p]["call"]()
-            )
-        except Exception as e:
-            logger.error(e)
-    status_scheduler.enter(
-        period, 1, status, (mqttc, properties, status_scheduler, period, base_topic)
+async def status(mqttc, tick_plan, status_topic):
+    """Publish status, return the tick plan without the failed properties."""
+    loop = asyncio.get_running_loop()
+    # sample everything first so the publishes go out back-to-back
+    snap = await loop.run_in_executor(executor, snapshot)
+    results = await asyncio.gather(
+        *(
+            loop.run_in_executor(executor, format_value, call, snap)
+            for _, call, _ in tick_plan
+        ),
+        return_exceptions=True,
     )
-
-    mqttc.publish(
-        MQTT_PS2MQTT_STATUS.format(base_topic),
-        MQTT_AVAILABLE,
+    messages = []
+    for (topic, _, ha_topic), result in zip(tick_plan, results):
+        if not isinstance(result, Exception):
+            failures.pop(topic, None)
+            messages.append((topic, result))
+            continue
+        failures[topic] = failures.get(topic, 0) + 1
+        logger.error("%s: %s", topic, result)
+        if failures[topic] >= MAX_FAILURES:
+            logger.error("Disabling %s after %s failures", topic, failures[topic])
+            tick_plan = [entry for entry in tick_plan if entry[0] != topic]
+            disabled.add(topic)
+            # an empty retained config removes the sensor from HA
+            mqttc.publish(ha_topic, b"", retain=True)
+
+    changed = []
+    with published_lock:
+        for topic, payload in messages:
+            sent, skipped = published.get(topic, (None, 0))
+            if payload == sent and skipped < REPUBLISH_UNCHANGED_TICKS - 1:
+                published[topic] = sent, skipped + 1
+                continue
+            published[topic] = payload, 0
+            changed.append((topic, payload))
+
+    for topic, payload in changed:
+        mqttc.publish(topic, payload)
+    mqttc.publish(status_topic, MQTT_AVAILABLE)
+
+    return tick_plan
+
+
+async def status_loop(mqttc, tick_plan, period, status_topic, deadline):
+    """Publish status every period, starting at deadline, until cancelled."""
+    while True:
+        await asyncio.sleep(deadline - time.monotonic())
+        tick_plan = await status(mqttc, tick_plan, status_topic)
+
+        # ticks are anchored to the first one so they don't drift, late ones are skipped
+        deadline += period
+        while deadline <= time.monotonic():
+            deadline += period
+
+
+async def run(mqttc, tick_plan, period, status_topic, first_tick):
+    """Run the status loop and leave the broker cleanly on SIGINT/SIGTERM."""
+    task = asyncio.create_task(
+        status_loop(mqttc, tick_plan, period, status_topic, first_tick)
     )
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, task.cancel)
+
+    try:
+        await task
+    except asyncio.CancelledError:
+        logger.info("Shutting down")
+    finally:
+        mqttc.publish(status_topic, MQTT_NOT_AVAILABLE, retain=True)
+        mqttc.disconnect()
+        mqttc.loop_stop()
 
 
 def publish_ha_discovery(client, properties, config):
     """Publish HA discovery information."""
 
+    with published_lock:  # state isn't retained, resend it with the discovery
+        published.clear()
     client.publish(
         MQTT_PS2MQTT_STATUS.format(config["mqtt_base_topic"]),
         MQTT_AVAILABLE,
         retain=False,
     )
     for p in properties.keys():
+        if properties[p]["state_topic"] in disabled:
+            continue
         logger.debug("HA Discovery configuration for %s", p)
         client.publish(
-            HA_DISCOVERY_PREFIX.format(
-                config["ha_discover_prefix"], slugify(platform.node()), p
-            ),
-            gen_ha_config(p, properties, config["mqtt_base_topic"]),
+            properties[p]["ha_topic"],
+            properties[p]["ha_config"],
             retain=True,
         )
 
 
-def on_message(client, userdata, _flags):
+def on_message(client, userdata, message):
     """MQTT Message callback."""
-    publish_ha_discovery(client, *userdata)
+    if message.payload == MQTT_AVAILABLE.encode():  # HA (re)started
+        publish_ha_discovery(client, *userdata)
 
 
-def on_connect(client, userdata, _flags, _result):
+def on_connect(client, userdata, flags, reason_code, _properties):
     """MQTT Connect callback."""
 
+    global ha_discovery_sent
+
+    if reason_code.is_failure:
+        logger.error("Connection refused: %s", reason_code)
+        return
+
     _, config = userdata
+    with published_lock:  # the broker may have lost our last values
+        published.clear()
     client.subscribe(config["ha_status_topic"])
-    publish_ha_discovery(client, *userdata)
+    # retained configs survive our reconnects, unless the broker lost its state
+    if not ha_discovery_sent or not flags.session_present:
+        publish_ha_discovery(client, *userdata)
+        ha_discovery_sent = True
 
 
 def main():
@@ -221,7 +388,7 @@ def main():
         if args.config:
             with open(args.config, "r") as infile:
                 logger.debug("Loading configuration from <%s>", args.config)
-                config_file = yaml.safe_load(infile)
+                config_file = yaml.load(infile, Loader=SafeLoader)
     except FileNotFoundError:
         logger.info(
             "Configuration file %s not found. Using default values", args.config
@@ -268,16 +435,46 @@ def main():
                     outfile,
                     default_flow_style=False,
                     allow_unicode=True,
-                    Dumper=Dumper,
+                    Dumper=SafeDumper,
                 )
                 logger.info("Saving configuration in %s", args.config)
 
     properties = load_properties(config["storage_paths"].split(","))
 
+    # read every property once: drops the ones that can't work on this host and
+    # primes cpu_percent and rates, which are relative to the previous reading
+    first_snap = snapshot()
+    for p in list(properties):
+        try:
+            properties[p]["call"](first_snap)
+        except Exception as e:
+            logger.error("Disabling %s: %s", p, e)
+            del properties[p]
+    first_tick = time.monotonic() + min(config["period"], MIN_FIRST_TICK_DELAY)
+
+    for p in properties.keys():  # topics and payloads never change, render them once
+        properties[p]["state_topic"] = MQTT_STATE_TOPIC.format(
+            config["mqtt_base_topic"], p
+        )
+        properties[p]["ha_topic"] = HA_DISCOVERY_PREFIX.format(
+            config["ha_discover_prefix"], NODE_SLUG, p
+        )
+        properties[p]["ha_config"] = gen_ha_config(
+            p, properties, config["mqtt_base_topic"]
+        )
+
+    # each tick only needs where to publish, what to call and what to retract
+    tick_plan = [
+        (prop["state_topic"], prop["call"], prop["ha_topic"])
+        for prop in properties.values()
+    ]
+
     logger.debug("Connecting to %s:%s", config["mqtt_server"], config["mqtt_port"])
     mqttc = mqtt.Client(
-        client_id=slugify(f"ps2mqtt {platform.node()}"),
+        mqtt.CallbackAPIVersion.VERSION2,
+        client_id=slugify(f"ps2mqtt {NODE}"),
         userdata=(properties, config),
+        protocol=mqtt.MQTTv5,
     )
     mqttc.will_set(
         MQTT_PS2MQTT_STATUS.format(config["mqtt_base_topic"]),
@@ -290,20 +487,27 @@ def main():
     if "mqtt_username" in config and "mqtt_password" in config:
         mqttc.username_pw_set(config["mqtt_username"], config["mqtt_password"])
 
-    try:
-        mqttc.connect(config["mqtt_server"], config["mqtt_port"], 60)
-        mqttc.loop_start()
+    connect_properties = Properties(PacketTypes.CONNECT)
+    connect_properties.SessionExpiryInterval = SESSION_EXPIRY
 
-        status_scheduler = sched.scheduler(time.time, time.sleep)
-        status(
-            mqttc,
-            properties,
-            status_scheduler,
-            config["period"],
-            config["mqtt_base_topic"],
+    try:
+        mqttc.connect(
+            config["mqtt_server"],
+            config["mqtt_port"],
+            60,
+            properties=connect_properties,
         )
+        mqttc.loop_start()
 
-        status_scheduler.run()  # block indefinitely
+        asyncio.run(
+            run(
+                mqttc,
+                tick_plan,
+                config["period"],
+                MQTT_PS2MQTT_STATUS.format(config["mqtt_base_topic"]),
+                first_tick,
+            )
+        )  # block until signalled
 
     except Exception as e:
         logger.error(
@@ -17,7 +17,8 @@ setup(
     packages=["ps2mqtt"],
     install_requires=[
         "setuptools==70.0.0",
-        "paho-mqtt>=1.6.1",
+        "orjson>=3.6.0",
+        "paho-mqtt>=2.0.0",
         "python-slugify>=6.1.1",
         "psutil==5.9.0",
         "PyYAML==6.0",